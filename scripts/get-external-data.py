@@ -14,16 +14,22 @@ Some implicit assumptions are
 '''
 
 import yaml
+# The C loader from libyaml is much faster, when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 from urllib.parse import urlparse
 import os
 import re
 import argparse
 import shutil
+import contextlib
+import tempfile
 
 # modules for getting data
 import zipfile
 import requests
-import io
 
 # modules for converting and postgres loading
 import subprocess
@@ -31,6 +37,31 @@ import psycopg2
 
 import logging
 
+# mkstemp creates files only the owner can read, so files moved into place
+# get the permissions a plain open() would have given them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    '''Give a temporary path to write the new contents of filename to, and
+    move it into place once it is synced to disk. An interrupted run leaves
+    the old file behind rather than a partial one.'''
+    # Each writer gets its own temporary file, so writers never share one
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                        prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    os.fchmod(fd, 0o666 & ~UMASK)
+    os.close(fd)
+    try:
+        yield tmp_filename
+        with open(tmp_filename, 'rb') as fp:
+            os.fsync(fp.fileno())
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
 
 def database_setup(conn, temp_schema, schema, metadata_table):
     with conn.cursor() as cur:
@@ -146,19 +177,25 @@ class Downloader:
     def __exit__(self, *args, **kwargs):
         self.session.close()
 
-    def _download(self, url, headers=None):
+    def _download(self, url, filename, headers=None):
+        # Data is written straight to filename, so archives are never held in memory
         if url.startswith('file://'):
-            filename = url[7:]
+            src_filename = url[7:]
             if headers and 'If-Modified-Since' in headers:
-                if str(os.path.getmtime(filename)) == headers['If-Modified-Since']:
+                if str(os.path.getmtime(src_filename)) == headers['If-Modified-Since']:
                     return DownloadResult(status_code = requests.codes.not_modified)
-            with open(filename, 'rb') as fp:
-                return DownloadResult(status_code = 200, content = fp.read(),
-                                      last_modified = str(os.fstat(fp.fileno()).st_mtime))
-        response = self.session.get(url, headers=headers)
-        response.raise_for_status()
-        return DownloadResult(status_code = response.status_code, content = response.content,
-                              last_modified = response.headers.get('Last-Modified', None))
+            with atomic_write(filename) as tmp_filename:
+                shutil.copyfile(src_filename, tmp_filename)
+            return DownloadResult(status_code = 200, path = filename,
+                                  last_modified = str(os.path.getmtime(src_filename)))
+        with self.session.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code == requests.codes.ok:
+                with atomic_write(filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        fp.write(chunk)
+            return DownloadResult(status_code = response.status_code, path = filename,
+                                  last_modified = response.headers.get('Last-Modified', None))
 
     def download(self, url, name, opts, data_dir, table_last_modified):
         filename = os.path.join(data_dir, os.path.basename(urlparse(url).path))
@@ -166,9 +203,8 @@ class Downloader:
         if os.path.exists(filename) and os.path.exists(filename_lastmod):
             with open(filename_lastmod, 'r') as fp:
                 lastmod_cache = fp.read()
-            with open(filename, 'rb') as fp:
-                cached_data = DownloadResult(status_code = 200, content = fp.read(),
-                                             last_modified = lastmod_cache)
+            cached_data = DownloadResult(status_code = 200, path = filename,
+                                         last_modified = lastmod_cache)
         else:
             cached_data = None
             lastmod_cache = None
@@ -188,17 +224,21 @@ class Downloader:
                 # If none of those 2 exist, value will be None and it will have the same effect as not having If-Modified-Since set
                 headers = {'If-Modified-Since': table_last_modified or lastmod_cache}
 
-            response = self._download(url, headers)
+            response = self._download(url, filename, headers)
             # Check status codes
             if response.status_code == requests.codes.ok:
-                logging.info("  Download complete ({} bytes)".format(len(response.content)))
+                logging.info("  Download complete ({} bytes)".format(os.path.getsize(filename)))
                 download_happened = True
+                # The data is already in filename, and any lastmod left from
+                # before describes the old data
                 if opts.cache:
-                    # Write to cache
-                    with open(filename, 'wb') as fp:
-                        fp.write(response.content)
-                    with open(filename_lastmod, 'w') as fp:
+                    with atomic_write(filename_lastmod) as tmp_filename, open(tmp_filename, 'w') as fp:
                         fp.write(response.last_modified)
+                else:
+                    try:
+                        os.remove(filename_lastmod)
+                    except FileNotFoundError:
+                        pass
                 result = response
             elif response.status_code == requests.codes.not_modified:
                 # Now we need to figure out if our not modified data came from table or cache
@@ -214,20 +254,29 @@ class Downloader:
 
 
         if opts.delete_cache or (not opts.cache and download_happened):
-            try:
-                os.remove(filename)
-                os.remove(filename_lastmod)
-            except FileNotFoundError:
-                pass
+            if result is None:
+                remove_download(filename)
+            else:
+                # The file is still needed for the import, main() removes it after
+                result.remove = True
 
         return result
 
 
+def remove_download(filename):
+    try:
+        os.remove(filename)
+        os.remove(filename + '.lastmod')
+    except FileNotFoundError:
+        pass
+
+
 class DownloadResult:
-    def __init__(self, status_code, content=None, last_modified=None):
+    def __init__(self, status_code, path=None, last_modified=None, remove=False):
         self.status_code = status_code
-        self.content = content
+        self.path = path
         self.last_modified = last_modified
+        self.remove = remove
 
 
 def main():
@@ -286,7 +335,7 @@ def main():
     logging.info("Starting load of external data into database")
 
     with open(opts.config) as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=SafeLoader)
         data_dir = opts.data or config["settings"]["data_dir"]
         os.makedirs(data_dir, exist_ok=True)
 
@@ -333,6 +382,8 @@ def main():
                 # Check if there is need to import
                 if download == None or (not opts.force and not opts.force_import and this_table.last_modified() == download.last_modified):
                     logging.info("  Table {} did not require updating".format(name))
+                    if download is not None and download.remove:
+                        remove_download(download.path)
                     continue
 
 
@@ -341,9 +392,11 @@ def main():
                 os.makedirs(workingdir, exist_ok=True)
                 if "archive" in source and source["archive"]["format"] == "zip":
                     logging.info("  Decompressing file")
-                    zip = zipfile.ZipFile(io.BytesIO(download.content))
-                    for member in source["archive"]["files"]:
-                        zip.extract(member, workingdir)
+                    # Read the archive from disk rather than from memory
+                    with zipfile.ZipFile(download.path) as zip:
+                        zip.extractall(workingdir, members=source["archive"]["files"])
+                if download.remove:
+                    remove_download(download.path)
 
                 ogrpg = "PG:dbname={}".format(database)
 
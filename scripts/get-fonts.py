@@ -5,57 +5,229 @@ designed to take its configuration from a file rather than be a series of shell
 commands.
 '''
 
-import yaml
 from urllib.parse import urlparse
 import os
 import argparse
 import shutil
+import json
+import contextlib
+import tempfile
+import asyncio
 
-# modules for getting data
-import requests
-import io
+import logging
 
-# modules for converting
-import subprocess
+# Modules that are slow to import, like yaml and httpx, are imported where
+# they are used, so a run with nothing to do starts quickly
 
-import logging
-from datetime import datetime
+# Size of the chunks downloads are streamed to disk in. Each chunk is
+# written in a worker thread, so large chunks keep the hand-offs few.
+CHUNK_SIZE = 1024 * 1024
+
+# Response headers compared by the HEAD check before downloading
+HEAD_HEADERS = ('Last-Modified', 'ETag', 'Content-Length')
+
+# Server errors worth retrying, how often, and the base of the backoff in seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# Seconds to wait for a connection, and for each read, write or pool slot
+# after that. httpx's 5 second default is too short for a slow font host.
+CONNECT_TIMEOUT = 30
+TIMEOUT = 60
+
+# Suffix of the file next to the cache listing the font files each source's
+# glyphs were built from. It is kept out of the glyph directory, which is
+# served publicly.
+SOURCES_STAMP = '.sources.json'
+
+
+# mkstemp creates files only the owner can read, so files moved into place
+# get the permissions a plain open() would have given them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def _temporary_file(filename):
+    # Each writer gets its own temporary file, so writers never share one
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                        prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    os.fchmod(fd, 0o666 & ~UMASK)
+    os.close(fd)
+    return tmp_filename
+
+
+def _commit_file(tmp_filename, filename):
+    with open(tmp_filename, 'rb') as fp:
+        os.fsync(fp.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def _discard_file(tmp_filename):
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
 
-class Downloader:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': 'get-fonts.py/spirit'})
 
-    def __enter__(self):
+@contextlib.contextmanager
+def atomic_write(filename):
+    '''Give a temporary path to write the new contents of filename to, and
+    move it into place once it is synced to disk. An interrupted run leaves
+    the old file behind rather than a partial one.'''
+    tmp_filename = _temporary_file(filename)
+    try:
+        yield tmp_filename
+        _commit_file(tmp_filename, filename)
+    finally:
+        _discard_file(tmp_filename)
+
+
+@contextlib.asynccontextmanager
+async def async_atomic_write(filename):
+    '''atomic_write for coroutines, with the file system work done in a
+    worker thread so other downloads carry on meanwhile'''
+    tmp_filename = await asyncio.to_thread(_temporary_file, filename)
+    try:
+        yield tmp_filename
+        await asyncio.to_thread(_commit_file, tmp_filename, filename)
+    finally:
+        await asyncio.to_thread(_discard_file, tmp_filename)
+
+
+def write_atomically(filename, text):
+    with atomic_write(filename) as tmp_filename, open(tmp_filename, 'w') as fp:
+        fp.write(text)
+
+
+class Downloader:
+    def __init__(self, jobs):
+        import importlib.util
+        import httpx
+
+        # With HTTP/2, requests to the same host share one connection, so
+        # use it when h2 is installed. httpx asks for compressed transfers by
+        # default, listing only the encodings it can decode.
+        http2 = importlib.util.find_spec('h2') is not None
+        # The client is shared by all downloads, so size its connection pool
+        # to the number of downloads running at once, and keep connections
+        # alive between requests to the same host
+        limits = httpx.Limits(max_connections=jobs, max_keepalive_connections=jobs)
+        transport = httpx.AsyncHTTPTransport(http2=http2, limits=limits, retries=RETRIES)
+        timeout = httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT)
+        self.client = httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True,
+                                        headers={'User-Agent': 'get-fonts.py/spirit'})
+        # Kept so the other methods don't need httpx imported
+        self.HTTPError = httpx.HTTPError
+
+    async def __aenter__(self):
         return self
 
-    def __exit__(self, *args, **kwargs):
-        self.session.close()
+    async def __aexit__(self, *args, **kwargs):
+        await self.client.aclose()
+
+    async def _request(self, method, url, headers=None):
+        '''Send a request, retrying transient server errors with a backoff.
+        The body is left unread, and the caller has to close the response.'''
+        for attempt in range(RETRIES + 1):
+            request = self.client.build_request(method, url, headers=headers)
+            response = await self.client.send(request, stream=True)
+            if response.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                return response
+            await response.aclose()
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+    async def _download(self, url, filename, headers=None):
+        '''Fetch url into filename, streaming the body to disk instead of
+        holding it in memory'''
+        from email.utils import parsedate
 
-    def _download(self, url, headers=None):
         if url.startswith('file://'):
-            filename = url[7:]
+            src_filename = url[7:]
+            src_mtime = os.path.getmtime(src_filename)
             if headers and 'If-Modified-Since' in headers:
-                if str(os.path.getmtime(filename)) == headers['If-Modified-Since']:
-                    return DownloadResult(status_code = requests.codes.not_modified)
-            with open(filename, 'rb') as fp:
-                return DownloadResult(status_code = 200, content = fp.read(),
-                                      last_modified = str(os.fstat(fp.fileno()).st_mtime))
-        response = self.session.get(url, headers=headers)
-        response.raise_for_status()
-        return DownloadResult(status_code = response.status_code, content = response.content,
-                              last_modified = response.headers.get('Last-Modified', None))
-
-    def download(self, url, name, opts, fonts_dir, filename, filename_lastmod, fontname):
-        if os.path.exists(filename) and os.path.exists(filename_lastmod):
+                # Compare as numbers, since mtimes can lose precision on some filesystems
+                try:
+                    cached_mtime = float(headers['If-Modified-Since'])
+                except ValueError:
+                    cached_mtime = None
+                if cached_mtime is not None and abs(src_mtime - cached_mtime) < 1.0:
+                    return DownloadResult(status_code = 304)
+            # copyfile lets the kernel do the copy where it can
+            async with async_atomic_write(filename) as tmp_filename:
+                await asyncio.to_thread(shutil.copyfile, src_filename, tmp_filename)
+            return DownloadResult(status_code = 200, path = filename,
+                                  last_modified = str(src_mtime))
+        if headers and 'If-Modified-Since' in headers and not parsedate(headers['If-Modified-Since']):
+            # Not an HTTP-date, so it is a file:// mtime or from an older
+            # version of this script. Don't send it to a server.
+            headers = {k: v for k, v in headers.items() if k != 'If-Modified-Since'}
+        response = await self._request('GET', url, headers)
+        try:
+            # httpx treats a 304 as an error too, so only raise for real ones
+            if response.is_error:
+                response.raise_for_status()
+            if response.status_code != 200:
+                return DownloadResult(status_code = response.status_code)
+            async with async_atomic_write(filename) as tmp_filename:
+                fp = await asyncio.to_thread(open, tmp_filename, 'wb')
+                try:
+                    # aiter_bytes undoes any Content-Encoding
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        await asyncio.to_thread(fp.write, chunk)
+                finally:
+                    await asyncio.to_thread(fp.close)
+        finally:
+            await response.aclose()
+        return DownloadResult(status_code = response.status_code, path = filename,
+                              last_modified = response.headers.get('Last-Modified', None),
+                              etag = response.headers.get('ETag', None),
+                              head = {k: response.headers[k] for k in HEAD_HEADERS if k in response.headers})
+
+    async def _head_unchanged(self, url, head_cache):
+        '''Check with a HEAD request if the resource still has the headers it
+        had when it was cached. This catches servers that ignore conditional
+        requests but otherwise report correct headers.'''
+        if url.startswith('file://') or not head_cache:
+            return False
+        try:
+            response = await self._request('HEAD', url)
+            await response.aclose()
+        except self.HTTPError:
+            # Let the GET decide
+            return False
+        if response.is_error:
+            return False
+        head = {k: response.headers[k] for k in HEAD_HEADERS if k in response.headers}
+        # A matching size alone doesn't mean the font is unchanged, so only
+        # trust the check when the server sends a validator
+        return ('Last-Modified' in head or 'ETag' in head) and head == head_cache
+
+    async def download(self, url, name, opts, fonts_dir, filename, filename_lastmod, fontname, cache_files):
+        # cache_files holds the names of all files in fonts_dir, read in one
+        # pass, so checking what is cached doesn't need a stat for each file
+        basename = os.path.basename(filename)
+        filename_etag = filename + '.etag'
+        filename_head = filename + '.head'
+        if basename in cache_files and basename + '.lastmod' in cache_files:
             with open(filename_lastmod, 'r') as fp:
-                lastmod_cache = fp.read()
-            with open(filename, 'rb') as fp:
-                cached_data = DownloadResult(status_code = 200, content = fp.read(),
-                                             last_modified = lastmod_cache)
+                lastmod_cache = fp.read() or None
+            if basename + '.etag' in cache_files:
+                with open(filename_etag, 'r') as fp:
+                    etag_cache = fp.read()
+            else:
+                etag_cache = None
+            if basename + '.head' in cache_files:
+                with open(filename_head, 'r') as fp:
+                    head_cache = json.load(fp)
+            else:
+                head_cache = None
+            # The cached file itself is only needed by its path
+            cached_data = DownloadResult(status_code = 200, path = filename,
+                                         last_modified = lastmod_cache, etag = etag_cache)
         else:
             cached_data = None
             lastmod_cache = None
+            etag_cache = None
+            head_cache = None
 
         result = None
 
@@ -64,27 +236,40 @@ class Downloader:
 
         if opts.no_update and (cached_data):
             result = cached_data
+        elif not opts.force and cached_data and await self._head_unchanged(url, head_cache):
+            logging.info("  Font {} did not require updating".format(fontname))
+            result = cached_data
         else:
             if opts.force:
                 headers = {}
             else:
 
-                # If not exist, value will be None and it will have the same effect as not having If-Modified-Since set
-                headers = {'If-Modified-Since': lastmod_cache}
+                # Servers may validate on either the date or the ETag, so send both
+                # of those we have. A server returning 304 for either is fine.
+                headers = {'If-Modified-Since': lastmod_cache, 'If-None-Match': etag_cache}
+                headers = {k: v for k, v in headers.items() if v is not None}
 
-            response = self._download(url, headers)
+            response = await self._download(url, filename, headers)
 
             # Check status codes
-            if response.status_code == requests.codes.ok:
-                logging.info("  Font {} was downloaded".format(fontname) + "({} bytes)".format(len(response.content)) )
+            if response.status_code == 200:
+                logging.info("  Font {} was downloaded".format(fontname) + "({} bytes)".format(os.path.getsize(filename)))
                 download_happened = True
 
-                with open(filename, 'wb') as fp:
-                    fp.write(response.content)
-                with open(filename_lastmod, 'w') as fp:
-                    fp.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                # The font is already in place, so an interrupted run can at
+                # worst leave stale sidecars, which only cost a new download
+                # Keep the server's value as is, so it can be sent back verbatim
+                await asyncio.to_thread(write_atomically, filename_lastmod, response.last_modified or '')
+                if response.etag:
+                    await asyncio.to_thread(write_atomically, filename_etag, response.etag)
+                elif basename + '.etag' in cache_files:
+                    os.remove(filename_etag)
+                if response.head:
+                    await asyncio.to_thread(write_atomically, filename_head, json.dumps(response.head))
+                elif basename + '.head' in cache_files:
+                    os.remove(filename_head)
                 result = response
-            elif response.status_code == requests.codes.not_modified:
+            elif response.status_code == 304:
                 result = cached_data
             else:
                 logging.critical("  Unexpected response code ({}".format(response.status_code))
@@ -95,13 +280,161 @@ class Downloader:
 
 
 class DownloadResult:
-    def __init__(self, status_code, content=None, last_modified=None):
+    def __init__(self, status_code, path=None, last_modified=None, etag=None, head=None):
         self.status_code = status_code
-        self.content = content
+        self.path = path
         self.last_modified = last_modified
+        self.etag = etag
+        self.head = head
+
+
+def glyphs_up_to_date(name, filenames, temp_fonts_dir, fonts_dir):
+    '''Check if the glyphs built for font name were built from exactly these
+    files, and are newer than all of them'''
+    try:
+        with open(os.path.join(temp_fonts_dir, name + SOURCES_STAMP)) as fp:
+            built_from = json.load(fp)
+        with os.scandir(os.path.join(fonts_dir, name)) as entries:
+            pbf_mtimes = [e.stat().st_mtime for e in entries if e.name.endswith('.pbf')]
+        src_mtimes = [os.path.getmtime(filename) for filename in filenames]
+    except (FileNotFoundError, ValueError):
+        return False
+    # A font added to or removed from the source needs a rebuild, even if
+    # the files themselves are older than the glyphs
+    if built_from != filenames:
+        return False
+    return bool(pbf_mtimes) and min(pbf_mtimes) >= max(src_mtimes, default=0)
+
+
+def install_glyphs(name, filenames, temp_fonts_dir, fonts_dir):
+    '''Move the glyphs font-maker built for font name into fonts_dir'''
+    workingdir = os.path.join(temp_fonts_dir, name)
+
+    shutil.rmtree(os.path.join(fonts_dir, name), ignore_errors=True)
+
+    shutil.move(os.path.join(workingdir, name), fonts_dir)
+
+    write_atomically(os.path.join(temp_fonts_dir, name + SOURCES_STAMP), json.dumps(filenames))
+
+
+async def convert(name, filenames, opts, temp_fonts_dir, fonts_dir, font_maker_dir):
+    import subprocess
+
+    if not opts.force and await asyncio.to_thread(glyphs_up_to_date, name, filenames, temp_fonts_dir, fonts_dir):
+        logging.info("  Glyphs of {} are up to date".format(name))
+    else:
+        workingdir = os.path.join(temp_fonts_dir, name)
+        await asyncio.to_thread(shutil.rmtree, workingdir, ignore_errors=True)
+
+        command = [
+            f"{font_maker_dir}/font-maker",
+            "--name",
+            name,
+            workingdir,
+        ] + filenames
+
+        # Wait on font-maker from the event loop, rather than from a thread
+        # of the pool the downloads write to disk with
+        process = await asyncio.create_subprocess_exec(*command)
+        if await process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+        await asyncio.to_thread(install_glyphs, name, filenames, temp_fonts_dir, fonts_dir)
+
+        logging.info("  Convert of {} complete".format(name))
+
+
+def delete_cache(filenames):
+    for filename in filenames:
+        for path in (filename, filename + '.lastmod', filename + '.etag', filename + '.head'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    logging.info("  Cache deleted")
+
+
+def warm_up_hosts(links):
+    '''Start looking up the hosts of all links in the background. Nothing
+    waits on the lookups, but where the system caches them, downloads that
+    open a connection to a host later don't wait for DNS.'''
+    loop = asyncio.get_running_loop()
+    hosts = {(url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+             for url in map(urlparse, links) if url.scheme in ('http', 'https')}
+    return [loop.create_task(loop.getaddrinfo(host, port)) for host, port in hosts]
+
+
+async def load_fonts(fonts, opts, temp_fonts_dir, fonts_dir, font_maker_dir):
+    '''Download all fonts concurrently, and convert each source as soon as
+    all of its files are in'''
+    with os.scandir(temp_fonts_dir) as entries:
+        cache_files = {entry.name for entry in entries}
+    # font-maker runs in its own process, so conversions of different
+    # sources can run side by side, one per CPU
+    conversions = asyncio.Semaphore(os.cpu_count() or 1)
+
+    async def convert_source(name, files):
+        async with conversions:
+            await convert(name, [filename for _, _, filename in files], opts,
+                          temp_fonts_dir, fonts_dir, font_maker_dir)
+
+    def is_cached(filename):
+        basename = os.path.basename(filename)
+        return basename in cache_files and basename + '.lastmod' in cache_files
+
+    if opts.no_update and all(is_cached(filename) for files in fonts.values() for _, _, filename in files):
+        # Nothing would be downloaded, so don't set up any networking at all
+        logging.info("  All fonts are cached, not checking for updates")
+        await asyncio.gather(*[convert_source(name, files) for name, files in fonts.items()])
+    else:
+        await download_and_convert(fonts, opts, temp_fonts_dir, cache_files, convert_source)
+
+    # Sources can share files, so only delete them once every source is converted
+    if opts.delete_cache:
+        delete_cache({filename for files in fonts.values() for _, _, filename in files})
+
+
+async def download_and_convert(fonts, opts, temp_fonts_dir, cache_files, convert_source):
+    downloads = asyncio.Semaphore(opts.jobs)
+
+    lookups = warm_up_hosts(link for files in fonts.values() for _, link, _ in files)
+    try:
+        async with Downloader(opts.jobs) as d:
+            async def download(name, fontname, link, filename):
+                async with downloads:
+                    return await d.download(link, name, opts, temp_fonts_dir,
+                                            filename, filename + '.lastmod', fontname, cache_files)
+
+            # Sources can share a font, so each cache file is downloaded by one
+            # task that every source using it waits on
+            tasks = {}
+
+            def fetch(name, fontname, link, filename):
+                if filename not in tasks:
+                    tasks[filename] = asyncio.ensure_future(download(name, fontname, link, filename))
+                return tasks[filename]
+
+            async def load(name, files):
+                await asyncio.gather(*[fetch(name, fontname, link, filename)
+                                       for fontname, link, filename in files])
+                await convert_source(name, files)
+
+            await asyncio.gather(*[load(name, files) for name, files in fonts.items()])
+    finally:
+        # Failures are left for the downloads to report
+        for lookup in lookups:
+            lookup.cancel()
+        await asyncio.gather(*lookups, return_exceptions=True)
 
 
 def main():
+    import yaml
+    # The C loader from libyaml is much faster, when PyYAML was built with it
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
     # parse options
     parser = argparse.ArgumentParser(
         description="Load and convert fonts")
@@ -120,6 +453,8 @@ def main():
                         help="Fonts download directory")
     parser.add_argument("-m", "--maker", action="store",
                         help="font_maker_dir")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=8,
+                        help="Number of fonts to download in parallel (default 8)")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Be more verbose. Overrides -q")
     parser.add_argument("-q", "--quiet", action="store_true",
@@ -127,12 +462,18 @@ def main():
 
     opts = parser.parse_args()
 
+    if opts.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     if opts.verbose:
         logging.basicConfig(level=logging.DEBUG)
     elif opts.quiet:
         logging.basicConfig(level=logging.WARNING)
     else:
         logging.basicConfig(level=logging.INFO)
+    if not opts.verbose:
+        # httpx logs every request at INFO
+        logging.getLogger('httpx').setLevel(logging.WARNING)
 
     if opts.force and opts.no_update:
         opts.no_update = False
@@ -141,56 +482,31 @@ def main():
     logging.info("Starting load of fonts")
 
     with open(opts.config) as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=SafeLoader)
         fonts_dir = opts.data or config["settings"]["fonts_dir"]
         temp_fonts_dir = fonts_dir + '_temp'
         font_maker_dir = opts.maker or config["settings"]["font_maker_dir"]
         os.makedirs(fonts_dir, exist_ok=True)
         os.makedirs(temp_fonts_dir, exist_ok=True)
 
-        with Downloader() as d:
-
-            for name, source in config["sources"].items():
-                filenames = [];
-                for fontname, links in source.items():
-                    for link in links:
-                        filename = os.path.join(temp_fonts_dir, os.path.basename(urlparse(link).path))
-                        filename_lastmod = filename + '.lastmod'
-                        filenames.append(filename)
-
-                        # Todo do Check if there is need to download
-
-                        # This will fetch fonts
-                        download = d.download(link, name, opts, temp_fonts_dir, filename, filename_lastmod, fontname)
-
-                workingdir = os.path.join(temp_fonts_dir, name)
-                shutil.rmtree(workingdir, ignore_errors=True)
-        
-                # Todo do Check if there is need to convert
-
-                font_maker_dir = os.path.expanduser(font_maker_dir)
-                command = [
-                    f"{font_maker_dir}/font-maker",
-                    "--name",
-                    name,
-                    workingdir,
-                ] + filenames
-
-                subprocess.run(command, check=True)
-
-                shutil.rmtree(os.path.join(fonts_dir, name), ignore_errors=True)
-
-                shutil.move(os.path.join(workingdir, name), fonts_dir)
-
-                logging.info("  Convert complete")
-
-                if opts.delete_cache:
-                    try:
-                        os.remove(filename)
-                        os.remove(filename_lastmod)
-                        logging.info("  Cache deleted")
-                    except FileNotFoundError:
-                        pass
+        font_maker_dir = os.path.expanduser(font_maker_dir)
+
+        # Work out where each font is cached once, before any downloading
+        fonts = {}
+        links = {}
+        for name, source in config["sources"].items():
+            fonts[name] = []
+            for fontname, source_links in source.items():
+                for link in source_links:
+                    filename = os.path.join(temp_fonts_dir, os.path.basename(urlparse(link).path))
+                    # Fonts are cached by file name, so two different links
+                    # can't share one
+                    if links.setdefault(filename, link) != link:
+                        raise RuntimeError(
+                            "Links {} and {} would both be cached as {}".format(links[filename], link, filename))
+                    fonts[name].append((fontname, link, filename))
+
+        asyncio.run(load_fonts(fonts, opts, temp_fonts_dir, fonts_dir, font_maker_dir))
 
 
 if __name__ == '__main__':